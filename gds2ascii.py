@@ -13,31 +13,76 @@
 ######################################################################
 
 import sys
+import math
+import mmap
 import struct
 import json
+import array
+import argparse
+import collections
+import functools
+import contextlib
+import concurrent.futures
 
 
+# Record header: record length (2 bytes), record type (1 byte), data type (1 byte).
+_HDR = struct.Struct('>HBB')
+
+# Compiled Struct unpacking n big-endian values of one format at once.
+#
+# input  : struct format character, number of values
+# return : (struct.Struct) the cached Struct for that shape
+@functools.lru_cache(maxsize=None)
+def _dataStruct(fmt, n):
+    return struct.Struct('>%d%s' % (n, fmt))
+
 # Reading Hex stream.
 #
-# input  : Hex format from raw file
-# return : (list) [ record length, [record type, data type], [data1, data2, ...] ]
-def readStream(stream):
-    try:
-        rec_data = []
-        rec_size = struct.unpack('>h', stream.read(2))[0]
-        stream.seek(0, 1)
-        rec_type = struct.unpack('>b', stream.read(1))[0]
-        stream.seek(0, 1)
-        dat_type = struct.unpack('>b', stream.read(1))[0]
-        stream.seek(0, 1)
-        dat_size = {0x00: 1, 0x01: 1, 0x02: 2, 0x03: 4, 0x04: 4, 0x05: 8, 0x06: 1}
-        for i in list(range(0, (rec_size-4)//dat_size[dat_type])):
-            rec_data.append( stream.read(dat_size[dat_type]) )
-            stream.seek(0, 1)
-        return [rec_size, [rec_type, dat_type], rec_data]
-
-    except:
-        return -1
+# input  : memory-mapped GDS buffer and the offset of a record header in it
+# return : (tuple) ( record length, record type, data type, offset of the record data ),
+#          or None when fewer than 4 bytes (no record header) are left
+# raise  : ValueError when the record length is below 4 or runs past the end of the file
+def readStream(buf, off):
+    if len(buf) - off < 4:
+        return None
+    rec_size, rec_type, dat_type = _HDR.unpack_from(buf, off)
+    if rec_size < 4:
+        raise ValueError('invalid record length %d at byte offset %d' % (rec_size, off))
+    if off + rec_size > len(buf):
+        raise ValueError('truncated record at byte offset %d: length %d, but only %d bytes left'
+                         % (off, rec_size, len(buf) - off))
+    return (rec_size, rec_type, dat_type, off+4)
+
+# Indexing all records of a GDS stream.
+#
+# input  : memory-mapped GDS buffer
+# return : (tuple) ( record offsets, record lengths, record types, data types ) as parallel arrays
+# raise  : ValueError when a record is malformed or the stream ends without an ENDLIB record
+def indexStream(buf):
+    offsets   = array.array('Q')
+    rec_sizes = array.array('H')
+    rec_types = array.array('B')
+    dat_types = array.array('B')
+
+    # The readStream global and the append attribute lookups are hoisted into locals once, not repeated per record.
+    read = readStream
+    add_offset, add_rec_size = offsets.append, rec_sizes.append
+    add_rec_type, add_dat_type = rec_types.append, dat_types.append
+
+    off = 0
+    while True:
+        header = read(buf, off)
+        if header is None:
+            raise ValueError('no ENDLIB record before the end of the file at byte offset %d' % off)
+        rec_size, rec_type, dat_type, _ = header
+        add_offset(off)
+        add_rec_size(rec_size)
+        add_rec_type(rec_type)
+        add_dat_type(dat_type)
+        off += rec_size
+        if rec_type == 0x04:
+            break
+    return (offsets, rec_sizes, rec_types, dat_types)
 
 #--------------------------------------------------------------------------------------------------
 # GDSII format
@@ -87,8 +132,6 @@ def readStream(stream):
 # input  : an IBM 370 representation of floating-point number as an 8-byte array in big-endian order
 # return : the double precision floating point number in the IEEE 754 format
 def ibm370_to_ieee754( ibm_bytes, debug=False ):
-    import math
-
     if debug:
         hex_string = ' '.join(['{:02x}'.format(b) for b in ibm_bytes])
         print( "Input IBM 370 floating-point number (hex) = %s" % hex_string )
@@ -119,86 +162,113 @@ def ibm370_to_ieee754( ibm_bytes, debug=False ):
         print( "    ==> Converted double value in the IEEE 754 format = %s" % ieee754_value )
     return ieee754_value
 
+# Convert a run of IBM 370 floating-point numbers to IEEE 754 format at once
+#
+# input  : bytes holding consecutive 8-byte IBM 370 floating-point numbers in big-endian order
+# return : (list) the double precision floating point numbers in the IEEE 754 format
+def ibm370_to_ieee754_batch( ibm_bytes ):
+    values = []
+    for word in _dataStruct('Q', len(ibm_bytes)//8).unpack_from(ibm_bytes, 0):
+        # Same steps as ibm370_to_ieee754(), applied to the whole 64-bit word:
+        # sign bit, excess-64 base-16 exponent and the 56-bit mantissa fraction.
+        exponent2 = 4 * (((word >> 56) & 0x7f) - 64) - 56
+        ieee754_value = math.ldexp( word & 0x00ffffffffffffff, exponent2 )
+        values.append( -ieee754_value if word >> 63 else ieee754_value )
+    return values
+
+# Record names indexed by record type; unassigned record types map to 'UNKNOWN'.
+_NAME_LIST = {0x00 : 'HEADER',
+              0x01 : 'BGNLIB',
+              0x02 : 'LIBNAME',
+              0x03 : 'UNITS',
+              0x04 : 'ENDLIB',
+              0x05 : 'BGNSTR',
+              0x06 : 'STRNAME',
+              0x07 : 'ENDSTR',
+              0x08 : 'BONDARY',
+              0x09 : 'PATH',
+              0x0A : 'SERF',
+              0x0B : 'AREF',
+              0x0C : 'TEXT',
+              0x0D : 'LAYER',
+              0x0E : 'DATATYPE',
+              0x0F : 'WIDTH',
+              0x10 : 'XY',
+              0x11 : 'ENDEL',
+              0x12 : 'SNAME',
+              0x13 : 'COLROW',
+              0x15 : 'NODE',
+              0x16 : 'TEXTTYPE',
+              0x17 : 'PRESENTATION',
+              0x19 : 'STRING',
+              0x1A : 'STRANS',
+              0x1B : 'MAG',
+              0x1C : 'ANGLE',
+              0x1F : 'REFLIBS',
+              0x20 : 'FONTS',
+              0x21 : 'PATHTYPE',
+              0x22 : 'GENERATIONS',
+              0x23 : 'ATTRATABLE',
+              0x26 : 'ELFLAGS',
+              0x2A : 'NODETYPE',
+              0x2B : 'PROPATTR',
+              0x2C : 'PROPVALUE',
+              0x2D : 'BOX',
+              0x2E : 'BOXTYPE',
+              0x2F : 'PLEX',
+              0x32 : 'TAPENUM',
+              0x33 : 'TAPECODE',
+              0x36 : 'FORMAT',
+              0x37 : 'MASK',
+              0x38 : 'ENDMASKS'
+              }
+_NAMES = tuple(_NAME_LIST.get(code, 'UNKNOWN') for code in range(256))
+
 # Reading Hex stream.
 #
-# input  : (list) [ record length, [record type, data type], [data1, data2, ...] ]
+# input  : (list) [ record length, [record type, data type], record data bytes ]
 # return : (string) record name
 def appendName(record):
-    name_list = {0x00 : 'HEADER',
-                0x01 : 'BGNLIB',
-                0x02 : 'LIBNAME',
-                0x03 : 'UNITS',
-                0x04 : 'ENDLIB',
-                0x05 : 'BGNSTR',
-                0x06 : 'STRNAME',
-                0x07 : 'ENDSTR',
-                0x08 : 'BONDARY',
-                0x09 : 'PATH',
-                0x0A : 'SERF',
-                0x0B : 'AREF',
-                0x0C : 'TEXT',
-                0x0D : 'LAYER',
-                0x0E : 'DATATYPE',
-                0x0F : 'WIDTH',
-                0x10 : 'XY',
-                0x11 : 'ENDEL',
-                0x12 : 'SNAME',
-                0x13 : 'COLROW',
-                0x15 : 'NODE',
-                0x16 : 'TEXTTYPE',
-                0x17 : 'PRESENTATION',
-                0x19 : 'STRING',
-                0x1A : 'STRANS',
-                0x1B : 'MAG',
-                0x1C : 'ANGLE',
-                0x1F : 'REFLIBS',
-                0x20 : 'FONTS',
-                0x21 : 'PATHTYPE',
-                0x22 : 'GENERATIONS',
-                0x23 : 'ATTRATABLE',
-                0x26 : 'ELFLAGS',
-                0x2A : 'NODETYPE',
-                0x2B : 'PROPATTR',
-                0x2C : 'PROPVALUE',
-                0x2D : 'BOX',
-                0x2E : 'BOXTYPE',
-                0x2F : 'PLEX',
-                0x32 : 'TAPENUM',
-                0x33 : 'TAPECODE',
-                0x36 : 'FORMAT',
-                0x37 : 'MASK',
-                0x38 : 'ENDMASKS'
-                }
-    return name_list[record[1][0]]
+    return _NAMES[record[1][0]]
+
+# Size in bytes of one value, indexed by data type.
+_DAT_SIZE = (1, 1, 2, 4, 4, 8, 1)
+
+# array typecodes of the fixed-size numeric data types. The C type behind 'i' and 'l'
+# differs between platforms, so the 4-byte integer code is picked by item size.
+_ARRAY_CODE = {dat_type: next(code for code in codes if array.array(code).itemsize == _DAT_SIZE[dat_type])
+               for dat_type, codes in ((0x02, 'h'), (0x03, 'il'), (0x04, 'f'))}
+
+# GDS data is big-endian; array holds values in the host byte order.
+_SWAP = sys.byteorder == 'little'
+
+# XY record data: flat x0, y0, x1, y1, ... coordinates, output as [[x0, y0], [x1, y1], ...] pairs.
+class XYArray(array.array):
+    pass
 
 # Extracting Hex Data to readable ASCii
 #
-# input  : (list) [ record length, [record type, data type], [data1, data2, ...] ]
-# return : (list) [ASCii data, ASCii data, ... ]
+# input  : (list) [ record length, [record type, data type], record data bytes ]
+# return : (list) [ASCii data, ASCii data, ... ], an array.array for integer and 4-byte real data
+#          (an XYArray for XY records), or (string) for ASCII data
 def extractData(record):
-    data = []
-    if record[1][1] == 0x00:
-        return data
+    dat_type = record[1][1]
 
-    elif record[1][1] == 0x01:
+    # Numeric records are by far the most frequent, so they are tested first.
+    if dat_type in _ARRAY_CODE:
+        # Trailing bytes that do not make up a whole value are dropped.
+        payload = record[2]
+        payload = payload[:len(payload) - len(payload) % _DAT_SIZE[dat_type]]
+        arrayType = XYArray if record[1][0] == 0x10 else array.array
+        data = arrayType(_ARRAY_CODE[dat_type], payload)
+        if _SWAP:
+            data.byteswap()
         return data
 
-    elif record[1][1] == 0x02:
-        for i in list(range(0, (record[0]-4)//2)):
-            data.append( struct.unpack('>h', record[2][i])[0] )
-        return data
+    elif dat_type == 0x00 or dat_type == 0x01:
+        return []
 
-    elif record[1][1] == 0x03:
-        for i in list(range(0, (record[0]-4)//4)):
-            data.append( struct.unpack('>l', record[2][i])[0] )
-        return data
-
-    elif record[1][1] == 0x04:
-        for i in list(range(0, (record[0]-4)//4)):
-            data.append( struct.unpack('>f', record[2][i])[0] )
-        return data
-
-    elif record[1][1] == 0x05:
+    elif dat_type == 0x05:
         """
         for i in list(range(0, (record[0]-4)//8)):
             data.append( struct.unpack('>d', record[2][i])[0] )
@@ -206,45 +276,149 @@ def extractData(record):
         """
 
         # The 8-byte array is for the 'UNITS' record, which is a floating point number in IBM 370 representation.
-        for i in list(range(0, (record[0]-4)//8)):
-            double8bytes = record[2][i]
-            ieee754FP = ibm370_to_ieee754( double8bytes, debug=False )
-            data.append(ieee754FP)
-        return data
+        return ibm370_to_ieee754_batch( record[2] )
     else:
-        for i in list(range(0, (record[0]-4))):
-            data.append( struct.unpack('>c', record[2][i])[0].decode("utf-8") )
-        return data
+        # ASCII strings are null-padded to an even length. Latin-1 maps every byte to a character,
+        # so text labels with bytes >= 0x80 written by some tools decode instead of failing.
+        return record[2].rstrip(b'\x00').decode('latin-1')
+
+# Converting decoded data that json cannot serialize by itself.
+#
+# input  : array.array of decoded values
+# return : (list) the same values as plain Python numbers, as [x, y] pairs for an XYArray
+#          (an XYArray with an odd number of values is kept flat so that no coordinate is lost)
+def toPlain(data):
+    if isinstance(data, XYArray) and len(data) % 2 == 0:
+        values = data.tolist()
+        return [[x, y] for x, y in zip(values[0::2], values[1::2])]
+    if isinstance(data, array.array):
+        return data.tolist()
+    raise TypeError('Object of type %s is not JSON serializable' % type(data).__name__)
+
+# Encoding one [name, data] output element as compact JSON.
+_encode = json.JSONEncoder(separators=(',', ':'), default=toPlain).encode
+
+# Decoding indexed records.
+#
+# input  : memory-mapped GDS buffer, (tuple) parallel index arrays as returned by indexStream()
+# yield  : (list) [ record name, data ] for every indexed record
+def decodeRecords(buf, index):
+    for off, rec_size, rec_type, dat_type in zip(*index):
+        record = [rec_size, [rec_type, dat_type], buf[off+4:off+rec_size]]
+        yield [appendName(record), extractData(record)]
+
+# Upper bounds of one chunk handed to a worker process (option -j/--jobs).
+_CHUNK_RECORDS = 10000
+_CHUNK_BYTES   = 4 * 1024 * 1024
+
+# Splitting the record index into chunks of at most _CHUNK_RECORDS records and _CHUNK_BYTES bytes.
+#
+# input  : (tuple) parallel index arrays as returned by indexStream()
+# yield  : (tuple) parallel index arrays of consecutive records
+def splitIndex(index):
+    rec_sizes = index[1]
+    start = 0
+    nbytes = 0
+    for i, rec_size in enumerate(rec_sizes):
+        if i > start and (i - start >= _CHUNK_RECORDS or nbytes + rec_size > _CHUNK_BYTES):
+            yield tuple(column[start:i] for column in index)
+            start = i
+            nbytes = 0
+        nbytes += rec_size
+    if start < len(rec_sizes):
+        yield tuple(column[start:] for column in index)
+
+# Decoding and encoding a chunk of records in a worker process (option -j/--jobs).
+#
+# input  : input .gds file path, (tuple) parallel index arrays of the chunk
+# return : (string) the JSON elements of the chunk, one per line
+def encodeChunk(inputFile, index):
+    with open(inputFile, mode='rb') as ifile, \
+         mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return ',\n'.join(_encode(item) for item in decodeRecords(buf, index))
+
+# Writing a JSON array one element at a time, so the whole output never has to be held in memory.
+#
+# input  : text stream opened for writing
+# usage  : writer.write([name, data]) for every record, then writer.close()
+class JsonArrayWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.first  = True
+        self.stream.write('[')
+
+    def write(self, item):
+        self.writeEncoded(_encode(item))
+
+    # input  : (string) one or more already encoded elements, separated by ',\n'
+    def writeEncoded(self, text):
+        if not text:
+            return
+        self.stream.write('\n' if self.first else ',\n')
+        self.stream.write(text)
+        self.first = False
+
+    def close(self):
+        self.stream.write('\n]\n')
 
 # Main
 # Command argument 1 : input .gds file path (mandatory)
 # Command argument 2 : output .json file path (optional)
+# Option -v/--verbose: print every record (always on when no output file is given)
+# Option -j/--jobs N : decode and encode the output in N worker processes (needs an output file, not with -v)
 def main():
-    if len(sys.argv) < 2 or sys.argv[1] == "-h":
-        print( "Usage:" )
-        print( "  $ gds2ascii.py <input.gds> [output.json]" )
-        print( "" )
+    parser = argparse.ArgumentParser(usage='gds2ascii.py [-v] [-j N] <input.gds> [output.json]')
+    parser.add_argument('inputFile', metavar='input.gds')
+    parser.add_argument('outputFile', metavar='output.json', nargs='?')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every record')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='number of worker processes encoding the JSON output; '
+                             'needs an output file and cannot be combined with -v (default: 1)')
+    if len(sys.argv) < 2:
+        parser.print_help()
         sys.exit(0)
-    inputFile = sys.argv[1]
-    if len(sys.argv) == 3:
-        outputFile = sys.argv[2]
-    else:
-        outputFile = None
-    asciiOut = []
-
-    with open(inputFile, mode='rb') as ifile:
-        while True:
-            record = readStream(ifile)
-            data = extractData(record)
-            name = appendName(record)
-            asciiOut.append([name, data])
-            print([name, data])
-            if record[1][0] == 0x04:
-                break
-
-        if not outputFile == None:
-            with open(outputFile, 'w') as ofile:
-                json.dump(asciiOut, ofile, indent=4)
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('-j/--jobs must be at least 1')
+    if args.jobs > 1 and args.outputFile is None:
+        parser.error('-j/--jobs requires an output file')
+    if args.jobs > 1 and args.verbose:
+        parser.error('-j/--jobs cannot be combined with -v/--verbose')
+    verbose = args.verbose or args.outputFile is None
+
+    with contextlib.ExitStack() as stack:
+        ifile = stack.enter_context(open(args.inputFile, mode='rb'))
+        buf   = stack.enter_context(mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ))
+        # The whole stream is checked before the output file is opened, so a broken input
+        # never leaves a partial JSON file behind.
+        try:
+            index = indexStream(buf)
+        except ValueError as e:
+            sys.exit('gds2ascii.py: error: %s: %s' % (args.inputFile, e))
+        writer = None
+        if args.outputFile is not None:
+            writer = JsonArrayWriter(stack.enter_context(open(args.outputFile, 'w')))
+
+        if args.jobs > 1:
+            # At most two chunks per worker are in flight, so memory stays bounded by the chunk size
+            # instead of growing with the file. Results are written in submission order.
+            pending = collections.deque()
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+                for chunk in splitIndex(index):
+                    if len(pending) >= 2 * args.jobs:
+                        writer.writeEncoded(pending.popleft().result())
+                    pending.append(executor.submit(encodeChunk, args.inputFile, chunk))
+                while pending:
+                    writer.writeEncoded(pending.popleft().result())
+        else:
+            for name, data in decodeRecords(buf, index):
+                if writer is not None:
+                    writer.write([name, data])
+                if verbose:
+                    print([name, toPlain(data) if isinstance(data, array.array) else data])
+
+        if writer is not None:
+            writer.close()
 
 
 if __name__ == '__main__':